@@ -1,8 +1,9 @@
 from __future__ import annotations
 
 import logging
+import sys
 from dataclasses import dataclass, field
-from enum import Enum, auto
+from enum import IntEnum, auto
 from typing import Optional, Protocol
 
 import setting
@@ -17,13 +18,13 @@ BROADCAST_MAC = "ffff"
 logger = logging.getLogger(__name__)
 
 
-class PacketType(Enum):
+class PacketType(IntEnum):
     ARP = auto()
     ICMP_REQUEST = auto()
     ICMP_REPLY = auto()
 
 
-@dataclass
+@dataclass(slots=True)
 class Packet:
     type: PacketType
     source_name: str
@@ -36,8 +37,11 @@ class Packet:
 class NetworkDevice(Protocol):
     name: str
 
-    def add(self, node: Self) -> None:
-        """Link with another network device"""
+    def next_port(self) -> PortNumber:
+        """The port number the next link will use"""
+
+    def add(self, node: Self, peer_port: PortNumber) -> None:
+        """Link with another network device, which uses `peer_port` for the link"""
 
     def show_table(self):
         """Show the ARP or MAC table"""
@@ -45,20 +49,25 @@ class NetworkDevice(Protocol):
     def clear(self):
         """Clear the ARP or MAC table"""
 
-    def handle_packet(self, packet: Packet):
-        """Handle the incoming packet"""
+    def handle_packet(self, packet: Packet, from_port: PortNumber):
+        """Handle the incoming packet from the given port"""
 
 
-@dataclass
+@dataclass(slots=True)
 class Host:
     name: str
     ip: IpAddress
     mac: MacAddress
     port_to: Optional[NetworkDevice] = None
+    peer_port: PortNumber = 0
     arp_table: dict[IpAddress, MacAddress] = field(default_factory=dict)
 
-    def add(self, node: NetworkDevice):
+    def next_port(self) -> PortNumber:
+        return 0
+
+    def add(self, node: NetworkDevice, peer_port: PortNumber):
         self.port_to = node
+        self.peer_port = peer_port
 
     def show_table(self, show_header: bool = True):
         """Display ARP table entries for this host"""
@@ -80,7 +89,7 @@ class Host:
 
         self.arp_table[ip] = mac
 
-    def handle_packet(self, packet: Packet):
+    def handle_packet(self, packet: Packet, from_port: PortNumber):
         """Handle incoming packets"""
 
         if packet.destination_mac not in (self.mac, BROADCAST_MAC):
@@ -118,8 +127,8 @@ class Host:
     def ping(self, dest_ip: IpAddress):
         """Send a ping request"""
 
-        if dest_ip not in self.arp_table:
-            # send an ARP request
+        if (dest_mac := self.arp_table.get(dest_ip)) is None:
+            # send an ARP request, the reply fills in the ARP table
             arp_packet = self.prepare_packet(
                 type=PacketType.ARP,
                 destination_ip=dest_ip,
@@ -127,7 +136,7 @@ class Host:
             )
             self.send(arp_packet)
 
-        dest_mac = self.arp_table[dest_ip]
+            dest_mac = self.arp_table[dest_ip]
 
         # send an ICMP request to the destination
         icmp_packet = self.prepare_packet(
@@ -142,11 +151,15 @@ class Host:
             logger.error(f"Host {self.name} has no port to send packets")
             return
 
-        logger.debug(
-            f"{self.name} sends an {packet.type.name} packet to {packet.destination_ip}"
-        )
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(
+                "%s sends an %s packet to %s",
+                self.name,
+                packet.type.name,
+                packet.destination_ip,
+            )
 
-        self.port_to.handle_packet(packet)
+        self.port_to.handle_packet(packet, self.peer_port)
 
     def prepare_packet(
         self, type: PacketType, destination_ip: IpAddress, destination_mac: MacAddress
@@ -161,14 +174,26 @@ class Host:
         )
 
 
-@dataclass
+@dataclass(slots=True)
 class Switch:
     name: str
     mac_table: dict[MacAddress, PortNumber] = field(default_factory=dict)
     port_to: list[NetworkDevice] = field(default_factory=list)
+    peer_ports: list[PortNumber] = field(default_factory=list)
+    broadcast_ports: list[list[PortNumber]] = field(default_factory=list)
+    """Ports to broadcast to when a packet comes from each port."""
+
+    def next_port(self) -> PortNumber:
+        return len(self.port_to)
+
+    def add(self, node: NetworkDevice, peer_port: PortNumber):
+        port = self.next_port()
+        for ports in self.broadcast_ports:
+            ports.append(port)
+        self.broadcast_ports.append(list(range(port)))
 
-    def add(self, node: NetworkDevice):
         self.port_to.append(node)
+        self.peer_ports.append(peer_port)
 
     def show_table(self, show_header: bool = True):
         """Display MAC table entries for this switch"""
@@ -190,47 +215,39 @@ class Switch:
 
         self.mac_table[mac_address] = from_port
 
-    def get_port_by_name(self, name: str):
-        return next(i for i, node in enumerate(self.port_to) if node.name == name)
-
     def send_to_ports(self, packet: Packet, exclude: PortNumber):
-        for i, _ in enumerate(self.port_to):
-            if i == exclude:
-                continue
-
+        for i in self.broadcast_ports[exclude]:
             self.send(i, packet)
 
-    def handle_packet(self, packet: Packet):
+    def handle_packet(self, packet: Packet, from_port: PortNumber):
         """Handle incoming packets"""
 
-        source_port = self.get_port_by_name(packet.source_name)
-
-        self.update_mac(packet.source_mac, source_port)
+        self.update_mac(packet.source_mac, from_port)
 
         if packet.type == PacketType.ARP and packet.destination_mac == BROADCAST_MAC:
             # broadcast the packet
-            return self.send_to_ports(packet, exclude=source_port)
+            return self.send_to_ports(packet, exclude=from_port)
 
         destination_port = self.mac_table.get(packet.destination_mac)
 
         if destination_port is None:
             # flood the packet
-            return self.send_to_ports(packet, exclude=source_port)
+            return self.send_to_ports(packet, exclude=from_port)
 
         self.send(destination_port, packet)
 
     def send(self, index: PortNumber, packet: Packet):
         """Send to the specific port"""
 
-        packet.source_name = self.name
-        self.port_to[index].handle_packet(packet)
+        self.port_to[index].handle_packet(packet, self.peer_ports[index])
 
 
 def create_link(node1: NetworkDevice, node2: NetworkDevice):
     """Create a link between two nodes"""
 
-    node1.add(node2)
-    node2.add(node1)
+    port1, port2 = node1.next_port(), node2.next_port()
+    node1.add(node2, peer_port=port2)
+    node2.add(node1, peer_port=port1)
 
 
 class Net:
@@ -242,11 +259,13 @@ class Net:
         ip_table: dict[str, IpAddress],
         mac_table: dict[str, MacAddress],
     ):
+        # the addresses are the keys of every ARP and MAC table, interning them
+        # lets the table lookups and comparisons hit the identity fast path
         self.host_dict: dict[str, Host] = {
             host_name: Host(
                 name=host_name,
-                ip=ip_table[host_name],
-                mac=mac_table[host_name],
+                ip=sys.intern(ip_table[host_name]),
+                mac=sys.intern(mac_table[host_name]),
             )
             for host_name in hosts
         }
@@ -1,34 +1,36 @@
 from __future__ import annotations
 
-import functools
-import itertools
+import math
 import random
-import re
-from dataclasses import dataclass
-from enum import Enum
-from typing import Callable, Iterable, Sequence, TypeVar
+from dataclasses import dataclass, field
+from enum import IntEnum
+from typing import Callable
 
+import numpy as np
 from setting import Setting
 
 
-class TransmissionStatus(Enum):
-    Start = "<"
-    Sending = "-"
-    Success = ">"
-    Idle = "."
-    Collision = "|"
+class TransmissionStatus(IntEnum):
+    Start = 0
+    Sending = 1
+    Success = 2
+    Idle = 3
+    Collision = 4
 
     def __str__(self) -> str:
-        return self.value
+        return "<->.|"[self]
 
-    def is_idle_lossy(self):
-        return self in (self.Idle, self.Success, self.Collision)
 
+# bound once to skip the enum attribute lookup in the per-tick loops
+_START, _SENDING, _SUCCESS, _IDLE, _COLLISION = TransmissionStatus
 
-SUCCESS_PATTERN = re.compile(r"<-*>")
+# maps the status codes of a history to their characters with `bytes.translate`
+STATUS_CHARS = bytes.maketrans(
+    bytes(TransmissionStatus), "".join(map(str, TransmissionStatus)).encode()
+)
 
 
-@dataclass
+@dataclass(slots=True)
 class Host:
     packets: list[int]
     """Timepoints when the host generates a packet."""
@@ -36,84 +38,98 @@ class Host:
     sending_progress: int = 0
     """The progress of sending a packet."""
 
-    def is_sending(self) -> bool:
-        return self.sending_progress > 0
+    head: int = 0
+    """Index of the packet being sent, packets before it are finished."""
 
-    def has_packet(self, time: int) -> bool:
-        return len(self.packets) > 0 and self.packets[0] <= time
+    next_packet_time: float = field(init=False)
+    """When the packet at `head` can be sent, `inf` if all packets are sent."""
 
-    def get_action(self, time: int) -> TransmissionStatus:
-        if self.is_sending():
-            return TransmissionStatus.Sending
+    def __post_init__(self):
+        self.next_packet_time = self.packets[0] if self.packets else math.inf
 
-        if self.has_packet(time):
-            return TransmissionStatus.Start
+    def is_sending(self) -> bool:
+        return self.sending_progress > 0
 
-        return TransmissionStatus.Idle
+    def has_packet(self, time: int) -> bool:
+        return self.next_packet_time <= time
 
     def wait_until(self, time: int):
-        self.packets[0] = time
+        self.next_packet_time = time
 
     def finish_packet(self):
         self.sending_progress = 0
-        self.packets.pop(0)
+        self.head += 1
+        self.next_packet_time = (
+            self.packets[self.head] if self.head < len(self.packets) else math.inf
+        )
+
 
+def count_success_slots(history: np.ndarray) -> int:
+    """Count the time slots of a host's history covered by `<-*>` runs."""
 
-def extract_success_packets(history: list[TransmissionStatus]):
-    return SUCCESS_PATTERN.findall("".join(map(str, history)))
+    success = np.flatnonzero(history == _SUCCESS)
+    not_sending = np.flatnonzero(history != _SENDING)
 
+    # the slot right before the `-*` run ending at each success
+    before = np.searchsorted(not_sending, success) - 1
+    has_before = before >= 0
+    success, starts = success[has_before], not_sending[before[has_before]]
 
-def calculate_statistics(setting: Setting, history: list[list[TransmissionStatus]]):
-    """Calculate the statistics of the simulation."""
+    is_packet = history[starts] == _START
+    return int((success[is_packet] - starts[is_packet] + 1).sum())
 
-    success_packets = itertools.chain(*(extract_success_packets(h) for h in history))
-    success_count = sum(len(success_packet) for success_packet in success_packets)
 
-    idle_count = sum(
-        all(h[i] == TransmissionStatus.Idle for h in history)
-        for i in range(setting.total_time)
-    )
+def calculate_statistics(setting: Setting, history: np.ndarray):
+    """Calculate the statistics of the simulation.
+
+    `history` is a (total_time, host_num) matrix of `TransmissionStatus` codes.
+    """
+
+    success_count = sum(count_success_slots(h) for h in history.T)
+    idle_count = int((history == _IDLE).all(axis=1).sum())
 
     success_rate = success_count / setting.total_time
     idle_rate = idle_count / setting.total_time
     return (success_rate, idle_rate, 1 - success_rate - idle_rate)
 
 
-T = TypeVar("T")
-
-
-def transposed(m: Iterable[Iterable[T]]) -> list[list[T]]:
-    return [list(row) for row in zip(*m)]
+ProtocolImpl = Callable[
+    [list[Host], list[list[TransmissionStatus]], list[int], Setting, int],
+    None,
+]
 
 
-def mac_protocol(
-    impl: Callable[
-        [list[Host], list[list[TransmissionStatus]], Setting, int],
-        list[TransmissionStatus],
-    ]
-) -> Callable[[Setting, bool], tuple[float, float, float]]:
+class mac_protocol:
     """Decorator for creating MAC protocols."""
 
-    @functools.wraps(impl)
-    def wrapper(
-        setting: Setting, show_history: bool = False
+    def __init__(self, impl: ProtocolImpl):
+        self.impl = impl
+        self.__name__ = impl.__name__
+        self.__doc__ = impl.__doc__
+
+    def __call__(
+        self, setting: Setting, show_history: bool = False
     ) -> tuple[float, float, float]:
+        impl = self.impl
         packets = setting.gen_packets()
-        hosts = [Host(p.copy()) for p in packets]
-        history: list[list[TransmissionStatus]] = []
+        hosts = [Host(p) for p in packets]
+        # `impl` fills in the row of `time` and only reads the rows before it
+        history: list[list[TransmissionStatus]] = [
+            [_IDLE] * len(hosts) for _ in range(setting.total_time)
+        ]
+        # number of non-idle slots of all hosts before each time
+        non_idle_total = [0] * (setting.total_time + 1)
 
         for time in range(setting.total_time):
-            actions = impl(hosts, history, setting, time)
-
-            # update the history
-            history.append(actions)
+            impl(hosts, history, non_idle_total, setting, time)
 
-        history = transposed(history)
+        # the protocols only touch plain lists, convert the history at once
+        statuses = np.array(history, dtype=np.uint8)
 
         if show_history:
-            print(impl.__name__)
+            print(self.__name__)
 
-            for i, h in enumerate(history):
+            for i, h in enumerate(statuses.T):
                 # print a 'V' on the timepoint when the host generates a packet
                 spaces = " " * len(f"h{i}: ")
                 generated_timestamps = "".join(
@@ -123,224 +139,250 @@ def mac_protocol(
                 print(f"{spaces}{generated_timestamps}")
 
                 # print the history of the host
-                print(f"h{i}:", "".join(map(str, h)))
+                print(f"h{i}:", h.tobytes().translate(STATUS_CHARS).decode())
 
             print()
 
-        return calculate_statistics(setting, history)
+        return calculate_statistics(setting, statuses)
 
-    return wrapper
 
+def count_non_idle(actions: list[TransmissionStatus]) -> int:
+    return len(actions) - actions.count(_IDLE)
 
-def update_progress(
-    hosts: Iterable[Host], actions: Iterable[TransmissionStatus]
-) -> None:
-    for host, action in zip(hosts, actions):
-        if action == TransmissionStatus.Sending:
-            host.sending_progress += 1
-        if action == TransmissionStatus.Start:
-            host.sending_progress = 1
 
-
-def finished_hosts(hosts: Iterable[Host], packet_time: int):
-    yield from (
-        (i, host)
-        for i, host in enumerate(hosts)
-        if host.sending_progress == packet_time
-    )
-
-
-def non_self_statuses(history: Iterable[Sequence[TransmissionStatus]], host_id: int):
-    for h in history:
-        yield from itertools.chain(h[:host_id], h[host_id + 1 :])
+def count_busy(statuses: list[TransmissionStatus]) -> int:
+    return statuses.count(_START) + statuses.count(_SENDING)
 
 
 @mac_protocol
 def aloha(
     hosts: list[Host],
     history: list[list[TransmissionStatus]],
+    non_idle_total: list[int],
     setting: Setting,
     time: int,
-) -> list[TransmissionStatus]:
-    # decide the action of each host
-    actions = [host.get_action(time) for host in hosts]
+):
+    actions = history[time]
+    finished: list[int] = []
+
+    # decide the action of each host and update its sending progress
+    for i, host in enumerate(hosts):
+        if host.is_sending():
+            actions[i] = _SENDING
+            host.sending_progress += 1
+        elif host.has_packet(time):
+            actions[i] = _START
+            host.sending_progress = 1
+        else:
+            actions[i] = _IDLE
+            continue
 
-    # update the sending progress of each host
-    update_progress(hosts, actions)
+        if host.sending_progress == setting.packet_time:
+            finished.append(i)
+
+    non_idle_total[time + 1] = non_idle_total[time] + count_non_idle(actions)
 
     # stop sending if the packet is finished
-    for i, host in finished_hosts(hosts, setting.packet_time):
+    for i in finished:
+        host = hosts[i]
         host.sending_progress = 0
-        has_collision = any(
-            status != TransmissionStatus.Idle
-            for status in non_self_statuses(
-                itertools.chain(history[-setting.packet_time + 1 :], (actions,)),
-                i,
-            )
+        # the host itself is not idle during the whole packet time
+        has_collision = (
+            non_idle_total[time + 1] - non_idle_total[time + 1 - setting.packet_time]
+            > setting.packet_time
         )
 
         if has_collision:
-            actions[i] = TransmissionStatus.Collision
-            host.wait_until(time + random.randint(1, setting.max_colision_wait_time))
+            actions[i] = _COLLISION
+            host.wait_until(
+                time + random.randrange(1, setting.max_colision_wait_time + 1)
+            )
             continue
 
         host.finish_packet()
-        actions[i] = TransmissionStatus.Success
-
-    return actions
+        actions[i] = _SUCCESS
 
 
 @mac_protocol
 def slotted_aloha(
     hosts: list[Host],
     history: list[list[TransmissionStatus]],
+    non_idle_total: list[int],
     setting: Setting,
     time: int,
-) -> list[TransmissionStatus]:
-    # decide the action of each host
-    actions = [host.get_action(time) for host in hosts]
+):
+    actions = history[time]
+    finished: list[int] = []
 
     # one can only start sending if it's at the beginning of the time slot
     can_start = time % setting.packet_time == 0
-    for i, action in enumerate(actions):
-        if action == TransmissionStatus.Start and not can_start:
-            actions[i] = TransmissionStatus.Idle
 
-    # update the sending progress of each host
-    update_progress(hosts, actions)
+    # decide the action of each host and update its sending progress
+    for i, host in enumerate(hosts):
+        if host.is_sending():
+            actions[i] = _SENDING
+            host.sending_progress += 1
+        elif can_start and host.has_packet(time):
+            actions[i] = _START
+            host.sending_progress = 1
+        else:
+            actions[i] = _IDLE
+            continue
+
+        if host.sending_progress == setting.packet_time:
+            finished.append(i)
+
+    non_idle_total[time + 1] = non_idle_total[time] + count_non_idle(actions)
 
     # stop sending if the packet is finished
-    for i, host in finished_hosts(hosts, setting.packet_time):
+    for i in finished:
+        host = hosts[i]
         host.sending_progress = 0
-        has_collision = any(
-            status != TransmissionStatus.Idle
-            for status in non_self_statuses(
-                itertools.chain(history[-setting.packet_time + 1 :], (actions,)),
-                i,
-            )
+        # the host itself is not idle during the whole packet time
+        has_collision = (
+            non_idle_total[time + 1] - non_idle_total[time + 1 - setting.packet_time]
+            > setting.packet_time
         )
 
         if has_collision:
-            actions[i] = TransmissionStatus.Collision
-
-            # calculate the time to resend the packet
-            wait_slot_num = sum(
-                itertools.takewhile(
-                    lambda _: random.random() > setting.p_resend, itertools.repeat(1)
-                )
+            actions[i] = _COLLISION
+
+            # calculate the time to resend the packet, the number of slots
+            # skipped before resending follows a geometric distribution
+            wait_slot_num = (
+                int(math.log1p(-random.random()) / math.log1p(-setting.p_resend))
+                if setting.p_resend < 1
+                else 0
             )
 
             host.wait_until(time + 1 + (wait_slot_num * setting.packet_time))
             continue
 
         host.finish_packet()
-        actions[i] = TransmissionStatus.Success
-
-    return actions
+        actions[i] = _SUCCESS
 
 
 @mac_protocol
 def csma(
     hosts: list[Host],
     history: list[list[TransmissionStatus]],
+    non_idle_total: list[int],
     setting: Setting,
     time: int,
-) -> list[TransmissionStatus]:
+):
+    # the statuses on the link reach the hosts after the link delay
+    sensed = history[time - setting.link_delay - 1]
+    busy_num = count_busy(sensed) if time > setting.link_delay else 0
+
     def can_start(host_id: int):
-        result = time <= setting.link_delay or all(
-            status.is_idle_lossy()
-            for status in non_self_statuses(
-                (history[-setting.link_delay - 1],),
-                host_id,
-            )
-        )
-        return result
+        # no host other than itself is sending
+        return busy_num == 0 or busy_num == (sensed[host_id] <= _SENDING)
 
-    # decide the action of each host
-    actions = [host.get_action(time) for host in hosts]
+    actions = history[time]
+    finished: list[int] = []
 
-    # one can only start sending if there's no packet being sent in the link
-    for i, (host, action) in enumerate(zip(hosts, actions)):
-        if action == TransmissionStatus.Start and not can_start(i):
-            actions[i] = TransmissionStatus.Idle
+    # decide the action of each host and update its sending progress
+    for i, host in enumerate(hosts):
+        if host.is_sending():
+            actions[i] = _SENDING
+            host.sending_progress += 1
+        elif not host.has_packet(time):
+            actions[i] = _IDLE
+            continue
+        elif can_start(i):
+            actions[i] = _START
+            host.sending_progress = 1
+        else:
+            # one can only start sending if there's no packet being sent in the
+            # link, wait for a random time before trying again
+            actions[i] = _IDLE
+            host.wait_until(
+                time + random.randrange(1, setting.max_colision_wait_time + 1)
+            )
+            continue
 
-            # wait for a random time before trying again
-            host.wait_until(time + random.randint(1, setting.max_colision_wait_time))
+        if host.sending_progress == setting.packet_time:
+            finished.append(i)
 
-    # update the sending progress of each host
-    update_progress(hosts, actions)
+    non_idle_total[time + 1] = non_idle_total[time] + count_non_idle(actions)
 
     # stop sending if the packet is finished
-    for i, host in finished_hosts(hosts, setting.packet_time):
+    for i in finished:
+        host = hosts[i]
         host.sending_progress = 0
 
-        has_collision = any(
-            status != TransmissionStatus.Idle
-            for status in non_self_statuses(
-                itertools.chain(history[-setting.packet_time + 1 :], (actions,)),
-                i,
-            )
+        # the host itself is not idle during the whole packet time
+        has_collision = (
+            non_idle_total[time + 1] - non_idle_total[time + 1 - setting.packet_time]
+            > setting.packet_time
         )
 
         if has_collision:
-            actions[i] = TransmissionStatus.Collision
-            host.wait_until(time + random.randint(1, setting.max_colision_wait_time))
+            actions[i] = _COLLISION
+            host.wait_until(
+                time + random.randrange(1, setting.max_colision_wait_time + 1)
+            )
             continue
 
         host.finish_packet()
-        actions[i] = TransmissionStatus.Success
-
-    return actions
+        actions[i] = _SUCCESS
 
 
 @mac_protocol
 def csma_cd(
     hosts: list[Host],
     history: list[list[TransmissionStatus]],
+    non_idle_total: list[int],
     setting: Setting,
     time: int,
-) -> list[TransmissionStatus]:
-    def can_start(host_id: int):
-        result = time <= setting.link_delay or all(
-            status.is_idle_lossy()
-            for status in non_self_statuses(
-                (history[-setting.link_delay - 1],),
-                host_id,
-            )
-        )
-        return result
+):
+    # the statuses on the link reach the hosts after the link delay
+    sensed = history[time - setting.link_delay - 1]
+    busy_num = count_busy(sensed) if time > setting.link_delay else 0
 
-    # decide the action of each host
-    actions = [host.get_action(time) for host in hosts]
+    def can_start(host_id: int):
+        # no host other than itself is sending
+        return busy_num == 0 or busy_num == (sensed[host_id] <= _SENDING)
 
-    # one can only start sending if there's no packet being sent in the link
-    for i, (host, action) in enumerate(zip(hosts, actions)):
-        if action == TransmissionStatus.Start and not can_start(i):
-            actions[i] = TransmissionStatus.Idle
+    actions = history[time]
 
-            # wait for a random time before trying again
-            host.wait_until(time + random.randint(1, setting.max_colision_wait_time))
+    # decide the action of each host and update its sending progress
+    for i, host in enumerate(hosts):
+        if host.is_sending():
+            actions[i] = _SENDING
+            host.sending_progress += 1
+        elif not host.has_packet(time):
+            actions[i] = _IDLE
+        elif can_start(i):
+            actions[i] = _START
+            host.sending_progress = 1
+        else:
+            # one can only start sending if there's no packet being sent in the
+            # link, wait for a random time before trying again
+            actions[i] = _IDLE
+            host.wait_until(
+                time + random.randrange(1, setting.max_colision_wait_time + 1)
+            )
 
-    # update the sending progress of each host
-    update_progress(hosts, actions)
+    non_idle_total[time + 1] = non_idle_total[time] + count_non_idle(actions)
 
     # detect collision, or stop sending if the packet is finished
     for i, host in enumerate(hosts):
-        if actions[i] == TransmissionStatus.Idle:
+        if actions[i] == _IDLE:
             continue
 
-        has_collision = time > setting.link_delay and any(
-            status != TransmissionStatus.Idle
-            for status in non_self_statuses(
-                (history[-setting.link_delay - 1],),
-                i,
-            )
+        sensed_time = time - setting.link_delay - 1
+        has_collision = time > setting.link_delay and (
+            non_idle_total[sensed_time + 1] - non_idle_total[sensed_time]
+            > (history[sensed_time][i] != _IDLE)
         )
 
         if has_collision:
             host.sending_progress = 0
-            host.wait_until(time + random.randint(1, setting.max_colision_wait_time))
-            actions[i] = TransmissionStatus.Collision
+            host.wait_until(
+                time + random.randrange(1, setting.max_colision_wait_time + 1)
+            )
+            actions[i] = _COLLISION
             continue
 
         if host.sending_progress != setting.packet_time:
@@ -348,6 +390,4 @@ def csma_cd(
             continue
 
         host.finish_packet()
-        actions[i] = TransmissionStatus.Success
-
-    return actions
+        actions[i] = _SUCCESS
@@ -1,6 +1,8 @@
 import random
 from typing import Optional
 
+import numpy as np
+
 
 class Setting:
     def __init__(
@@ -52,11 +54,16 @@ class Setting:
     #    [20, 30, 50], # host 1
     #    [30, 50, 60]] # host 2
     def gen_packets(self):
-        def generate_for_host():
-            max_timepoint = self.total_time - self.packet_size
-            timepoints = random.sample(range(1, max_timepoint), self.packet_num)
-            return sorted(timepoints)
-
+        # the protocols draw their random wait times from `random`
         random.seed(self.seed)
-        packets = [generate_for_host() for _ in range(self.host_num)]
-        return packets
+
+        rng = np.random.default_rng(self.seed)
+        max_timepoint = self.total_time - self.packet_size
+
+        # distinct timepoints in [1, max_timepoint) for each host
+        timepoints = [
+            rng.choice(max_timepoint - 1, size=self.packet_num, replace=False)
+            for _ in range(self.host_num)
+        ]
+        packets = np.sort(timepoints, axis=1) + 1
+        return packets.tolist()
@@ -5,7 +5,9 @@ from __future__ import annotations
 import heapq
 import itertools
 import logging
+import math
 import pprint
+from collections import defaultdict
 from dataclasses import dataclass
 from typing import Generic, Protocol, TypeVar
 
@@ -25,20 +27,23 @@ T = TypeVar("T", bound=Message)
 
 
 class MessageService(Generic[T]):
+    __slots__ = ("messages",)
+
     def __init__(self):
-        self.messages: list[T] = []
+        # messages grouped by their destination
+        self.messages: defaultdict[int, list[T]] = defaultdict(list)
 
     def send(self, message: T):
-        self.messages.append(message)
+        self.messages[message.destination].append(message)
 
     def get_messages(self, id: int) -> list[T]:
-        return [m for m in self.messages if m.destination == id]
+        return self.messages.get(id, [])
 
     def reset(self):
-        self.messages = []
+        self.messages = defaultdict(list)
 
 
-@dataclass
+@dataclass(slots=True)
 class LinkState:
     source: int
     destination: int
@@ -55,6 +60,8 @@ class OspfRouter:
             for i, _ in enumerate(link_cost)
         ]
         self.updated_link_states = [(id, link_cost)]
+        # the neighbor each updated link state was received from
+        self.link_state_sources: dict[int, int] = {}
 
     def __repr__(self):
         return f"OspfRouter(id={self.id})"
@@ -63,11 +70,14 @@ class OspfRouter:
         """Send the link state to the router."""
 
         for id, link_cost in self.updated_link_states:
-            # do not send the link state to the router itself
-            if id == router.id:
+            # do not send the link state to the router itself, or back to the
+            # neighbor it came from, which already has it
+            if id == router.id or self.link_state_sources.get(id) == router.id:
                 continue
 
-            logger.debug(f"Router {self.id} sends link state of {id} to {router.id}.")
+            logger.debug(
+                "Router %d sends link state of %d to %d.", self.id, id, router.id
+            )
             service.send(
                 LinkState(
                     source=self.id,
@@ -81,12 +91,8 @@ class OspfRouter:
         """Receive the link state sent by neighbors."""
 
         messages: list[LinkState] = []
-
-        def find_duplicate(link_cost: list[int]):
-            for i, message in enumerate(messages):
-                if message.link_cost == link_cost:
-                    return i
-            return None
+        # index of the message in `messages` carrying each link state
+        indices: dict[tuple[int, ...], int] = {}
 
         for message in service.get_messages(self.id):
             id = message.originator
@@ -96,17 +102,20 @@ class OspfRouter:
             if self.link_cost[id] == link_cost:
                 continue
 
-            logger.debug(f"Router {self.id} receives link state of {id}.")
+            logger.debug("Router %d receives link state of %d.", self.id, id)
 
-            if (idx := find_duplicate(link_cost)) is not None:
+            key = tuple(link_cost)
+            if (idx := indices.get(key)) is not None:
                 if messages[idx].source > message.source:
                     messages[idx] = message
 
                 continue
 
+            indices[key] = len(messages)
             messages.append(message)
 
         self.updated_link_states = [(m.originator, m.link_cost) for m in messages]
+        self.link_state_sources = {m.originator: m.source for m in messages}
         return messages
 
     def update(self) -> bool:
@@ -115,9 +124,10 @@ class OspfRouter:
         updated = False
 
         for id, link_cost in self.updated_link_states:
+            known_cost = self.link_cost[id]
             for i, cost in enumerate(link_cost):
-                if cost < self.link_cost[id][i]:
-                    self.link_cost[id][i] = cost
+                if cost < known_cost[i]:
+                    known_cost[i] = cost
                     updated = True
 
         return updated
@@ -125,30 +135,47 @@ class OspfRouter:
     def shortest_paths(self):
         """Get the shortest paths from the router to other routers."""
 
-        heap = [(0, self.id)]
-        shortest_path = [999] * len(self.link_cost)
+        # the known links of each router, without the absent ones
+        neighbors = [
+            [
+                (j, cost)
+                for j, cost in enumerate(link_cost)
+                if cost != NO_LINK and j != i
+            ]
+            for i, link_cost in enumerate(self.link_cost)
+        ]
+
+        shortest_path = [math.inf] * len(self.link_cost)
+        shortest_path[self.id] = 0
+
+        # start from the direct links of the router
+        heap = [(cost, i) for i, cost in neighbors[self.id]]
+        for cost, i in heap:
+            shortest_path[i] = cost
+        heapq.heapify(heap)
 
         while heap:
-            cost, id = heapq.heappop(heap)
-            if cost >= shortest_path[id]:
+            distance, id = heapq.heappop(heap)
+            # skip the stale entries of routers already reached by a shorter path
+            if distance > shortest_path[id]:
                 continue
-            shortest_path[id] = cost
-            for i, cost in enumerate(self.link_cost[id]):
-                path_distance = cost + shortest_path[id]
+
+            for i, cost in neighbors[id]:
+                path_distance = distance + cost
                 if path_distance < shortest_path[i]:
+                    shortest_path[i] = path_distance
                     heapq.heappush(heap, (path_distance, i))
 
-        return shortest_path
+        return [NO_LINK if cost == math.inf else cost for cost in shortest_path]
 
 
 def run_ospf(
     link_cost: list[list[int]],
 ) -> tuple[list[list[int]], list[tuple[int, int, int]]]:
     routers = [OspfRouter(i, cost) for i, cost in enumerate(link_cost)]
-    direct_links = [
-        (r1, r2)
-        for (i, r1), (j, r2) in itertools.permutations(enumerate(routers), 2)
-        if link_cost[i][j] != NO_LINK
+    neighbors = [
+        [routers[j] for j, cost in enumerate(costs) if cost != NO_LINK and j != i]
+        for i, costs in enumerate(link_cost)
     ]
     message_service: MessageService[LinkState] = MessageService()
 
@@ -158,8 +185,9 @@ def run_ospf(
     is_converged = False
 
     while not is_converged:
-        for r1, r2 in direct_links:
-            r1.send_link_state(r2, message_service)
+        for router in routers:
+            for neighbor in neighbors[router.id]:
+                router.send_link_state(neighbor, message_service)
 
         records.append([])
         for router in routers:
@@ -176,22 +204,26 @@ def run_ospf(
         message_service.reset()
 
     shortest_paths = [router.shortest_paths() for router in routers]
-    logs = list(itertools.chain(*(sorted(record) for record in records)))
+    logs = list(itertools.chain.from_iterable(sorted(record) for record in records))
 
     return shortest_paths, logs
 
 
-@dataclass
+@dataclass(slots=True)
 class DistanceVector:
     source: int
     destination: int
-    distance_vector: list[int]
+    distance_vector: list[float]
 
 
 class RipRouter:
     def __init__(self, id: int, distance_vector: list[int]):
         self.id = id
-        self.distance_vector = distance_vector.copy()
+        # unreachable routers are infinitely far, so that paths costing more
+        # than `NO_LINK` are still found
+        self.distance_vector: list[float] = [
+            math.inf if cost == NO_LINK else cost for cost in distance_vector
+        ]
         self.messages: list[DistanceVector] = []
         self.is_converged = False
 
@@ -204,7 +236,7 @@ class RipRouter:
         if self.is_converged:
             return
 
-        logger.debug(f"Router {self.id} sends its distance vector to {router.id}.")
+        logger.debug("Router %d sends its distance vector to %d.", self.id, router.id)
         service.send(
             DistanceVector(
                 source=self.id,
@@ -220,8 +252,9 @@ class RipRouter:
     def update(self) -> bool:
         new_distance_vector = self.distance_vector.copy()
         for message in self.messages:
+            source_cost = self.distance_vector[message.source]
             for i, cost in enumerate(message.distance_vector):
-                new_cost = cost + self.distance_vector[message.source]
+                new_cost = cost + source_cost
                 if new_cost < self.distance_vector[i]:
                     new_distance_vector[i] = new_cost
 
@@ -235,10 +268,9 @@ def run_rip(
     link_cost: list[list[int]],
 ) -> tuple[list[list[int]], list[tuple[int, int]]]:
     routers = [RipRouter(i, cost) for i, cost in enumerate(link_cost)]
-    direct_links = [
-        (r1, r2)
-        for (i, r1), (j, r2) in itertools.permutations(enumerate(routers), 2)
-        if link_cost[i][j] != NO_LINK
+    neighbors = [
+        [routers[j] for j, cost in enumerate(costs) if cost != NO_LINK and j != i]
+        for i, costs in enumerate(link_cost)
     ]
 
     message_service: MessageService[DistanceVector] = MessageService()
@@ -249,8 +281,13 @@ def run_rip(
     is_converged = False
 
     while not is_converged:
-        for r1, r2 in direct_links:
-            r1.send_distance_vector(r2, message_service)
+        for router in routers:
+            # a converged router has nothing new to tell its neighbors
+            if router.is_converged:
+                continue
+
+            for neighbor in neighbors[router.id]:
+                router.send_distance_vector(neighbor, message_service)
 
         records.append([])
         for router in routers:
@@ -264,8 +301,11 @@ def run_rip(
 
         message_service.reset()
 
-    shortest_paths = [router.distance_vector for router in routers]
-    logs = list(itertools.chain(*(sorted(record) for record in records)))
+    shortest_paths = [
+        [NO_LINK if cost == math.inf else cost for cost in router.distance_vector]
+        for router in routers
+    ]
+    logs = list(itertools.chain.from_iterable(sorted(record) for record in records))
 
     return shortest_paths, logs
 
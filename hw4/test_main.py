@@ -170,3 +170,19 @@ def test_rip():
             (3, 2),
         ],
     ), "RIP test 2 failed"
+
+
+def test_paths_beyond_no_link():
+    # a path costing more than 999 must not be mistaken for a missing link
+    link_cost = [
+        [0, 600, 999],
+        [600, 0, 600],
+        [999, 600, 0],
+    ]
+    expected = [[0, 600, 1200], [600, 0, 600], [1200, 600, 0]]
+
+    ospf_paths, _ = run_ospf(link_cost)
+    rip_paths, _ = run_rip(link_cost)
+
+    assert ospf_paths == expected, "OSPF long path test failed"
+    assert rip_paths == expected, "RIP long path test failed"
@@ -1,7 +1,7 @@
 from __future__ import annotations
 
-import ctypes
-from dataclasses import asdict, dataclass
+import struct
+from dataclasses import dataclass
 from enum import Enum, auto
 
 from utils import get_colored_logger
@@ -17,36 +17,29 @@ class QuicPacketType(Enum):
         return self.name
 
 
+# decodes the wire values without going through `Enum.__call__`
+PACKET_TYPES = {t.value: t for t in QuicPacketType}
+
+
 @dataclass
 class QuicPacketHeader:
     packet_type: QuicPacketType
     packet_number: int
 
-    class Struct(ctypes.BigEndianStructure):
-        _fields_ = [
-            ("packet_type", ctypes.c_uint8),
-            ("packet_number", ctypes.c_uint32),
-        ]
-
-        def to_dict(self):
-            return dict((field, getattr(self, field)) for field, _ in self._fields_)
+    # packet type, padding, packet number
+    _struct = struct.Struct(">B3xI")
 
     @classmethod
-    def from_bytes(cls, data: bytes) -> QuicPacketHeader:
-        obj = cls.Struct.from_buffer_copy(data)
-        values = obj.to_dict()
-        values["packet_type"] = QuicPacketType(values["packet_type"])
-        return cls(**values)
+    def from_bytes(cls, data: bytes, offset: int = 0) -> QuicPacketHeader:
+        packet_type, packet_number = cls._struct.unpack_from(data, offset)
+        return cls(PACKET_TYPES[packet_type], packet_number)
 
     def to_bytes(self) -> bytes:
-        values = asdict(self)
-        values["packet_type"] = values["packet_type"].value
-        obj = self.Struct(**values)
-        return bytes(obj)
+        return self._struct.pack(self.packet_type.value, self.packet_number)
 
     @classmethod
     def size(cls) -> int:
-        return ctypes.sizeof(cls.Struct)
+        return cls._struct.size
 
 
 class QuicFrameType(Enum):
@@ -57,34 +50,27 @@ class QuicFrameType(Enum):
         return self.name
 
 
+FRAME_TYPES = {t.value: t for t in QuicFrameType}
+
+
 @dataclass
 class QuicFrameHeader:
     frame_type: QuicFrameType
 
-    class Struct(ctypes.BigEndianStructure):
-        _fields_ = [
-            ("frame_type", ctypes.c_uint8),
-        ]
-
-        def to_dict(self):
-            return dict((field, getattr(self, field)) for field, _ in self._fields_)
+    # frame type
+    _struct = struct.Struct(">B")
 
     @classmethod
-    def from_bytes(cls, data: bytes) -> QuicFrameHeader:
-        obj = cls.Struct.from_buffer_copy(data)
-        values = obj.to_dict()
-        values["frame_type"] = QuicFrameType(values["frame_type"])
-        return cls(**values)
+    def from_bytes(cls, data: bytes, offset: int = 0) -> QuicFrameHeader:
+        (frame_type,) = cls._struct.unpack_from(data, offset)
+        return cls(FRAME_TYPES[frame_type])
 
     def to_bytes(self) -> bytes:
-        values = asdict(self)
-        values["frame_type"] = values["frame_type"].value
-        obj = self.Struct(**values)
-        return bytes(obj)
+        return self._struct.pack(self.frame_type.value)
 
     @classmethod
     def size(cls) -> int:
-        return ctypes.sizeof(cls.Struct)
+        return cls._struct.size
 
 
 @dataclass
@@ -92,28 +78,19 @@ class QuicAckFrame:
     packet_number: int
     window_size: int
 
-    class Struct(ctypes.BigEndianStructure):
-        _fields_ = [
-            ("packet_number", ctypes.c_uint32),
-            ("window_size", ctypes.c_uint32),
-        ]
-
-        def to_dict(self):
-            return dict((field, getattr(self, field)) for field, _ in self._fields_)
+    # packet number, window size
+    _struct = struct.Struct(">II")
 
     @classmethod
-    def from_bytes(cls, data: bytes) -> QuicAckFrame:
-        obj = cls.Struct.from_buffer_copy(data)
-        values = obj.to_dict()
-        return cls(**values)
+    def from_bytes(cls, data: bytes, offset: int = 0) -> QuicAckFrame:
+        return cls(*cls._struct.unpack_from(data, offset))
 
     def to_bytes(self) -> bytes:
-        obj = self.Struct(**asdict(self))
-        return bytes(obj)
+        return self._struct.pack(self.packet_number, self.window_size)
 
     @classmethod
     def size(cls) -> int:
-        return ctypes.sizeof(cls.Struct)
+        return cls._struct.size
 
 
 @dataclass
@@ -122,29 +99,49 @@ class QuicStreamFrame:
     offset: int
     length: int
     finished: bool
-    data: bytes
+    data: bytes | memoryview
 
-    class Struct(ctypes.BigEndianStructure):
-        _fields_ = [
-            ("stream_id", ctypes.c_uint32),
-            ("offset", ctypes.c_uint64),
-            ("length", ctypes.c_uint16),
-            ("finished", ctypes.c_uint8),
-        ]
-
-        def to_dict(self):
-            return dict((field, getattr(self, field)) for field, _ in self._fields_)
+    # stream id, padding, offset, length, finished, padding
+    _struct = struct.Struct(">I4xQHB5x")
 
     @classmethod
-    def from_bytes(cls, data: bytes) -> QuicStreamFrame:
-        obj = cls.Struct.from_buffer_copy(data)
-        values = obj.to_dict()
-        return cls(**values, data=data[cls.size() :])
+    def from_bytes(cls, data: bytes, offset: int = 0) -> QuicStreamFrame:
+        stream_id, stream_offset, length, finished = cls._struct.unpack_from(
+            data, offset
+        )
+        return cls(
+            stream_id,
+            stream_offset,
+            length,
+            finished,
+            # `data` may be a view of a reused receive buffer
+            bytes(data[offset + cls._struct.size :]),
+        )
 
     def to_bytes(self) -> bytes:
-        obj = self.Struct(**asdict(self))
-        return bytes(obj) + self.data
+        header = self._struct.pack(
+            self.stream_id, self.offset, self.length, self.finished
+        )
+        return header + self.data
 
     @classmethod
     def size(cls) -> int:
-        return ctypes.sizeof(cls.Struct)
+        return cls._struct.size
+
+
+def build_packet(
+    header: QuicPacketHeader,
+    frame_header: QuicFrameHeader,
+    frame: QuicAckFrame | QuicStreamFrame,
+) -> bytes:
+    """Serialize a packet carrying a single frame."""
+
+    return b"".join((header.to_bytes(), frame_header.to_bytes(), frame.to_bytes()))
+
+
+def build_ack_packet(header: QuicPacketHeader, acks: list[QuicAckFrame]) -> bytes:
+    """Serialize a packet carrying an ACK frame for each of `acks`."""
+
+    frame_header = QuicFrameHeader(frame_type=QuicFrameType.Ack).to_bytes()
+    frames = (frame_header + ack.to_bytes() for ack in acks)
+    return b"".join((header.to_bytes(), *frames))
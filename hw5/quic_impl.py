@@ -1,9 +1,12 @@
 from __future__ import annotations
 
+import heapq
+import selectors
 import socket
 import time
+from collections import defaultdict, deque
 from dataclasses import dataclass
-from threading import Thread
+from threading import Condition, Event, Lock, Thread
 
 import utils
 from packet import (
@@ -13,6 +16,8 @@ from packet import (
     QuicPacketHeader,
     QuicPacketType,
     QuicStreamFrame,
+    build_ack_packet,
+    build_packet,
 )
 
 RETRY_COUNT = 3
@@ -21,6 +26,17 @@ PACKET_SIZE = 1500  # 1.5KB
 SSTHRESH = 64  # 64 packets
 TIMEOUT = 1.0  # 1 second
 
+# the encoded sizes, fixed for every packet
+PACKET_HEADER_SIZE = QuicPacketHeader.size()
+FRAME_HEADER_SIZE = QuicFrameHeader.size()
+ACK_FRAME_SIZE = QuicAckFrame.size()
+MAX_STREAM_SIZE = (
+    PACKET_SIZE - PACKET_HEADER_SIZE - FRAME_HEADER_SIZE - QuicStreamFrame.size()
+)
+ACKS_PER_PACKET = (PACKET_SIZE - PACKET_HEADER_SIZE) // (
+    FRAME_HEADER_SIZE + ACK_FRAME_SIZE
+)
+
 
 logger = utils.get_colored_logger("QUIC_IMPL")
 
@@ -30,6 +46,68 @@ class SenderWindowEntry:
     packet_number: int
     frame: QuicStreamFrame
     sent_time: float
+    # whether the window was full when the frame was first sent
+    window_limited: bool = False
+
+
+class StreamReassembler:
+    """Reassemble the messages of a stream from frames received in any order."""
+
+    def __init__(self) -> None:
+        self.data = bytearray()
+        # the stream offset of the start of `data`, the bytes before it are read
+        self.offset = 0
+        # frames received ahead of the end of `data`, keyed by their offset
+        self.pending: dict[int, QuicStreamFrame] = {}
+        # the stream offsets where the messages in `data` end, in order
+        self.message_ends: deque[int] = deque()
+
+    def __repr__(self) -> str:
+        return (
+            f"StreamReassembler(offset={self.offset}, received={len(self.data)}, "
+            f"pending={len(self.pending)}, messages={len(self.message_ends)})"
+        )
+
+    def add(self, frame: QuicStreamFrame) -> None:
+        """Add the data of a frame to the stream."""
+
+        end = self.offset + len(self.data)
+        if frame.offset != end:
+            # keep the frames after a gap until it is filled, and drop the
+            # retransmitted ones that are already received, or even read
+            if frame.offset > end:
+                self.pending[frame.offset] = frame
+            return
+
+        self.append(frame)
+
+        # the frames waiting for this one can follow it now
+        while (
+            frame := self.pending.pop(self.offset + len(self.data), None)
+        ) is not None:
+            self.append(frame)
+
+    def append(self, frame: QuicStreamFrame) -> None:
+        """Append the data of the frame right after the end of `data`."""
+
+        self.data += frame.data
+        # the last frame of a message, the next message starts right after it
+        if frame.finished:
+            self.message_ends.append(self.offset + len(self.data))
+
+    def has_message(self) -> bool:
+        """Whether a whole message of the stream is received and not read yet."""
+
+        return bool(self.message_ends)
+
+    def read(self) -> bytes:
+        """Take the next whole message of the stream out of the reassembler."""
+
+        size = self.message_ends.popleft() - self.offset
+        data = bytes(self.data[:size])
+        del self.data[:size]
+        self.offset += size
+        return data
 
 
 class QuicConnection:
@@ -39,20 +117,43 @@ class QuicConnection:
         """Initialize the QUIC connection."""
 
         self.socket = sock
-        self.is_closed = False
+        self.closed = Event()
+        # set whenever the sender thread may have something new to do
+        self.sender_wakeup = Event()
+        # written to by close() to wake the receiver thread up from select()
+        self.wakeup_reader, self.wakeup_writer = socket.socketpair()
         self.max_window_size = max_window_size
 
         self.sender = Thread(target=self.sender_thread)
         self.receiver = Thread(target=self.receiver_thread)
 
-        self.send_buffer: dict[int, list[QuicStreamFrame]] = {}
-        self.sender_window_size = 4
-        self.sender_window: list[SenderWindowEntry] = []
-        self.ack_list: list[QuicAckFrame] = []
+        # the frames of each stream still to send, taken in turns
+        self.send_buffer: deque[deque[QuicStreamFrame]] = deque()
+        # the queue in `send_buffer` of each stream being sent
+        self.send_streams: dict[int, deque[QuicStreamFrame]] = {}
+        # the stream offset the next message of each stream starts at
+        self.send_offsets: defaultdict[int, int] = defaultdict(int)
+        # guards the send buffer, which both send() and the sender thread change
+        self.send_lock = Lock()
+        # in packets, fractional to grow by less than a packet per ack
+        self.sender_window_size: float = 4
+        # the packets in flight, keyed by their packet number
+        self.sender_window: dict[int, SenderWindowEntry] = {}
+        # (deadline, packet number) of the packets in the window, a packet is
+        # (re)sent when its deadline passes, the earliest one on top
+        self.sender_deadlines: list[tuple[float, int]] = []
+        self.ack_list: deque[QuicAckFrame] = deque()
         self.exponential_growth = True
         self.packet_number = packet_number
+        # notified when a packet is acknowledged or the connection closes
+        self.sent_condition = Condition()
 
-        self.recv_buffer: dict[int, list[QuicStreamFrame]] = {}
+        self.recv_buffer: defaultdict[int, StreamReassembler] = defaultdict(
+            StreamReassembler
+        )
+        # guards the receive buffer, notified when a stream is complete or the
+        # connection closes
+        self.recv_condition = Condition()
 
         self.sender.start()
         self.receiver.start()
@@ -75,17 +176,17 @@ class QuicConnection:
 
         header = QuicPacketHeader.from_bytes(data)
         if header.packet_type != QuicPacketType.Initial:
-            logger.debug(f"Received a non-initial packet from {addr}")
+            logger.debug("Received a non-initial packet from %s", addr)
             return None
 
-        logger.debug(f"Received {header} from {addr}")
+        logger.debug("Received %s from %s", header, addr)
 
         # send an ACK packet to the client
         header = QuicPacketHeader(packet_type=QuicPacketType.Initial, packet_number=0)
         frame_header = QuicFrameHeader(frame_type=QuicFrameType.Ack)
         ack = QuicAckFrame(packet_number=header.packet_number, window_size=RECEIVE_SIZE)
 
-        packet = header.to_bytes() + frame_header.to_bytes() + ack.to_bytes()
+        packet = build_packet(header, frame_header, ack)
         sock.sendto(packet, addr)
 
         # receive the ACK packet from the clients
@@ -95,21 +196,19 @@ class QuicConnection:
 
         header = QuicPacketHeader.from_bytes(data)
         if header.packet_type != QuicPacketType.Initial:
-            logger.debug(f"Received a non-initial packet from {addr}")
+            logger.debug("Received a non-initial packet from %s", addr)
             return None
 
-        logger.debug(f"Received {header} from {addr}")
+        logger.debug("Received %s from %s", header, addr)
 
-        frame_header = QuicFrameHeader.from_bytes(data[QuicPacketHeader.size() :])
+        frame_header = QuicFrameHeader.from_bytes(data, PACKET_HEADER_SIZE)
         if frame_header.frame_type != QuicFrameType.Ack:
-            logger.debug(f"Received a non-ack frame from {addr}")
+            logger.debug("Received a non-ack frame from %s", addr)
             return None
 
-        ack = QuicAckFrame.from_bytes(
-            data[QuicPacketHeader.size() + QuicFrameHeader.size() :]
-        )
+        ack = QuicAckFrame.from_bytes(data, PACKET_HEADER_SIZE + FRAME_HEADER_SIZE)
         if ack.packet_number != header.packet_number:
-            logger.debug(f"Received an ack for the wrong packet from {addr}")
+            logger.debug("Received an ack for the wrong packet from %s", addr)
             return None
 
         sock.connect(addr)
@@ -128,7 +227,7 @@ class QuicConnection:
         frame_header = QuicFrameHeader(frame_type=QuicFrameType.Ack)
         ack = QuicAckFrame(packet_number=header.packet_number, window_size=RECEIVE_SIZE)
 
-        packet = header.to_bytes() + frame_header.to_bytes() + ack.to_bytes()
+        packet = build_packet(header, frame_header, ack)
         sock.send(packet)
 
         # receive the ACK packet from the server
@@ -140,16 +239,14 @@ class QuicConnection:
         if header.packet_type != QuicPacketType.Initial:
             raise RuntimeError("Failed to connect to the server")
 
-        logger.debug(f"Received {header} from {addr}")
+        logger.debug("Received %s from %s", header, addr)
 
-        frame_header = QuicFrameHeader.from_bytes(data[QuicPacketHeader.size() :])
+        frame_header = QuicFrameHeader.from_bytes(data, PACKET_HEADER_SIZE)
         if frame_header.frame_type != QuicFrameType.Ack:
-            logger.fatal(f"Expected: ACK, Received: {frame_header} from {addr}")
+            logger.fatal("Expected: ACK, Received: %s from %s", frame_header, addr)
             raise RuntimeError("Failed to connect to the server")
 
-        ack = QuicAckFrame.from_bytes(
-            data[QuicPacketHeader.size() + QuicFrameHeader.size() :]
-        )
+        ack = QuicAckFrame.from_bytes(data, PACKET_HEADER_SIZE + FRAME_HEADER_SIZE)
         if ack.packet_number != header.packet_number:
             raise RuntimeError("Failed to connect to the server")
 
@@ -158,7 +255,7 @@ class QuicConnection:
         frame_header = QuicFrameHeader(frame_type=QuicFrameType.Ack)
         ack = QuicAckFrame(packet_number=header.packet_number, window_size=RECEIVE_SIZE)
 
-        packet = header.to_bytes() + frame_header.to_bytes() + ack.to_bytes()
+        packet = build_packet(header, frame_header, ack)
         sock.send(packet)
 
         return cls(sock, ack.window_size, 2)
@@ -166,109 +263,151 @@ class QuicConnection:
     def send(self, stream_id: int, data: bytes) -> None:
         """Send data on the given stream."""
 
-        max_stream_size = (
-            PACKET_SIZE
-            - QuicPacketHeader.size()
-            - QuicFrameHeader.size()
-            - QuicStreamFrame.size()
-        )
+        with self.send_lock:
+            # the messages of a stream follow each other in its offsets, so
+            # the peer tells them apart from its retransmissions
+            start = self.send_offsets[stream_id]
+            self.send_offsets[stream_id] = start + len(data)
+
+            # split the data into multiple packets, the frames share the data
+            # instead of each copying its chunk
+            view = memoryview(data)
+            frames: list[QuicStreamFrame] = []
+            for i in range(0, len(data), MAX_STREAM_SIZE):
+                finished = i + MAX_STREAM_SIZE >= len(data)
+                frame = QuicStreamFrame(
+                    stream_id=stream_id,
+                    offset=start + i,
+                    length=len(data) - i if finished else MAX_STREAM_SIZE,
+                    data=view[i : i + MAX_STREAM_SIZE],
+                    finished=finished,
+                )
+                frames.append(frame)
 
-        # split the data into multiple packets
-        frames: list[QuicStreamFrame] = []
-        for i in range(0, len(data), max_stream_size):
-            finished = i + max_stream_size >= len(data)
-            frame = QuicStreamFrame(
-                stream_id=stream_id,
-                offset=i,
-                length=len(data) - i if finished else max_stream_size,
-                data=data[i : i + max_stream_size],
-                finished=finished,
-            )
-            frames.append(frame)
+            logger.debug("frames=%r", frames)
+
+            if not frames:
+                return
 
-        logger.debug(f"{frames=}")
+            # the sender thread pops the frames from the front, a message
+            # queues up behind the one still being sent on its stream
+            if (queue := self.send_streams.get(stream_id)) is not None:
+                queue.extend(frames)
+            else:
+                queue = self.send_streams[stream_id] = deque(frames)
+                self.send_buffer.append(queue)
 
-        self.send_buffer[stream_id] = frames
+        self.sender_wakeup.set()
 
     def recv(self) -> tuple[int, bytes]:
         """Receive data on any stream."""
 
-        while not self.is_closed:
-            logger.debug(f"{self.recv_buffer=}")
-            for stream_id, frames in self.recv_buffer.items():
-                if len(frames) == 0:
-                    continue
-
-                logger.debug(f"{frames=} {stream_id=}")
-                ordered_frames = sorted(frames, key=lambda f: f.offset)
-                if not ordered_frames[-1].finished:
-                    continue
-
-                if ordered_frames[0].offset != 0:
-                    continue
-
-                # check if the frames are contiguous
-                for i in range(len(ordered_frames) - 1):
-                    if (
-                        ordered_frames[i].offset + ordered_frames[i].length
-                        != ordered_frames[i + 1].offset
-                    ):
-                        break
-
-                # remove the frames from the receive buffer
-                data = b"".join(f.data for f in ordered_frames)
-                del self.recv_buffer[stream_id]
+        with self.recv_condition:
+            while not self.closed.is_set():
+                logger.debug("self.recv_buffer=%r", self.recv_buffer)
+                for stream_id, stream in self.recv_buffer.items():
+                    if not stream.has_message():
+                        continue
 
-                return stream_id, data
+                    # the stream stays in the receive buffer once read, so
+                    # that late retransmissions of it are dropped instead of
+                    # starting it over
+                    return stream_id, stream.read()
 
-            time.sleep(0.1)
+                # wait for the receiver thread to complete a message
+                self.recv_condition.wait()
 
         return -1, b""
 
     def close(self) -> None:
         """Close the connection and the socket."""
 
+        # already closed, the wake-up sockets are gone
+        if self.wakeup_writer.fileno() == -1:
+            return
+
         logger.info("Closing the connection")
 
-        self.is_closed = True
+        # let the peer acknowledge everything sent so far, but give up after
+        # `RETRY_COUNT` retransmission timeouts in case it has gone away
+        with self.sent_condition:
+            self.sent_condition.wait_for(
+                self.is_all_acknowledged, timeout=RETRY_COUNT * TIMEOUT
+            )
+
+        self.closed.set()
+        self.sender_wakeup.set()
+        self.wakeup_writer.send(b"\0")
         self.sender.join()
         self.receiver.join()
 
+        self.wakeup_reader.close()
+        self.wakeup_writer.close()
+
+    def is_all_acknowledged(self) -> bool:
+        """Whether all the data sent has been acknowledged, or never will be."""
+
+        if self.closed.is_set():
+            return True
+
+        return not self.sender_window and not self.send_buffer
+
     def sender_thread(self) -> None:
         """Thread that sends data on the socket."""
 
         while True:
-            while len(self.sender_window) < self.sender_window_size:
-                # move frames from the send buffer to the sender window
-                has_frames = False
-                send_buffer = self.send_buffer.copy()
-                for frames in send_buffer.values():
-                    if len(frames) == 0:
-                        continue
-
-                    if len(self.sender_window) >= self.sender_window_size:
-                        break
-
+            # cleared before the work, so nothing set during it is missed
+            self.sender_wakeup.clear()
+
+            # move frames from the send buffer to the sender window, a frame
+            # of each stream in turn
+            with self.send_lock:
+                while (
+                    self.send_buffer
+                    and len(self.sender_window) < self.sender_window_size
+                ):
+                    frames = self.send_buffer[0]
                     entry = SenderWindowEntry(
                         packet_number=self.get_packet_number(),
-                        frame=frames.pop(0),
+                        frame=frames[0],
                         sent_time=0,
                     )
-                    self.sender_window.append(entry)
-                    has_frames = True
-
-                if not has_frames:
-                    break
+                    self.sender_window[entry.packet_number] = entry
+                    # due to be sent right away
+                    heapq.heappush(self.sender_deadlines, (0, entry.packet_number))
+                    # taken from the buffer only once in the window, so the
+                    # frame is always in one of them for close()
+                    frames.popleft()
+
+                    if frames:
+                        self.send_buffer.rotate(-1)
+                    else:
+                        self.send_buffer.popleft()
+                        del self.send_streams[entry.frame.stream_id]
+
+            # a window that is not full does not limit the sending, the
+            # application has nothing more to send
+            is_window_full = len(self.sender_window) >= self.sender_window_size
 
             has_loss = False
-            for entry in self.sender_window:
-                if time.time() - entry.sent_time <= TIMEOUT:
+            # one clock read for the whole sweep over the due packets
+            now = time.time()
+            deadlines = self.sender_deadlines
+            while deadlines and deadlines[0][0] <= now:
+                _, packet_number = heapq.heappop(deadlines)
+                entry = self.sender_window.get(packet_number)
+                if entry is None:
+                    # acknowledged meanwhile
                     continue
 
+                heapq.heappush(deadlines, (now + TIMEOUT, packet_number))
+
                 if entry.sent_time != 0:
                     has_loss = True
+                else:
+                    entry.window_limited = is_window_full
 
-                entry.sent_time = time.time()
+                entry.sent_time = now
 
                 # send the frame
                 header = QuicPacketHeader(
@@ -277,89 +416,125 @@ class QuicConnection:
                 )
                 frame_header = QuicFrameHeader(frame_type=QuicFrameType.Stream)
 
-                packet = (
-                    header.to_bytes() + frame_header.to_bytes() + entry.frame.to_bytes()
-                )
-                logger.debug(f"Sending {header.packet_number} {entry}")
+                packet = build_packet(header, frame_header, entry.frame)
+                logger.debug("Sending %d %s", header.packet_number, entry)
                 self.socket.send(packet)
 
             if has_loss:
                 self.sender_window_size = max(1, self.sender_window_size // 2)
                 self.exponential_growth = False
 
-            # copy the ack list to avoid concurrent modification
-            ack_list = self.ack_list.copy()
-            if len(ack_list) > 0:
-                logger.debug(f"{ack_list=}")
-            for ack in ack_list:
+            if len(self.ack_list) > 0:
+                logger.debug("self.ack_list=%r", self.ack_list)
+            # coalesce the pending acks into as few packets as possible, taking
+            # them from the front while the receiver thread appends to the back
+            while self.ack_list:
+                count = min(len(self.ack_list), ACKS_PER_PACKET)
+                acks = [self.ack_list.popleft() for _ in range(count)]
                 header = QuicPacketHeader(
                     packet_type=QuicPacketType.OneRTT,
                     packet_number=self.get_packet_number(),
                 )
-                frame_header = QuicFrameHeader(frame_type=QuicFrameType.Ack)
-                packet = header.to_bytes() + frame_header.to_bytes() + ack.to_bytes()
-                logger.debug(f"Sending {ack}")
+                packet = build_ack_packet(header, acks)
+                logger.debug("Sending %s", acks)
                 self.socket.send(packet)
-                self.ack_list.remove(ack)
 
-            if self.is_closed and len(self.ack_list) == 0:
+            if self.closed.is_set() and len(self.ack_list) == 0:
                 break
 
+            # sleep until woken up or the next packet in the window times out
+            timeout = max(0, deadlines[0][0] - time.time()) if deadlines else None
+            self.sender_wakeup.wait(timeout)
+
     def receiver_thread(self) -> None:
         """Thread that receives data on the socket."""
 
+        # every packet is received into the same buffer, the frames copy out
+        # what they keep
+        buffer = bytearray(PACKET_SIZE)
+        view = memoryview(buffer)
+
         self.socket.setblocking(False)
-        while not self.is_closed:
+        selector = selectors.DefaultSelector()
+        selector.register(self.socket, selectors.EVENT_READ)
+        selector.register(self.wakeup_reader, selectors.EVENT_READ)
+
+        while not self.closed.is_set():
+            # wait for a packet instead of spinning on the non-blocking socket,
+            # close() wakes the selector up through `wakeup_reader`
+            selector.select()
+
             try:
-                data = self.socket.recv(PACKET_SIZE)
+                size = self.socket.recv_into(buffer)
             except BlockingIOError:
                 continue
             except ConnectionRefusedError:
-                self.is_closed = True
-                return
+                self.closed.set()
+                break
 
-            if not data:
+            if not size:
                 continue
 
+            data = view[:size]
+
             header = QuicPacketHeader.from_bytes(data)
-            logger.debug(f"Received {header}")
+            logger.debug("Received %s", header)
             if header.packet_type == QuicPacketType.Initial:
                 continue
 
-            frame_header = QuicFrameHeader.from_bytes(data[QuicPacketHeader.size() :])
+            # a packet carries either some ack frames or a single stream frame
+            offset = PACKET_HEADER_SIZE
+            while offset < size:
+                frame_header = QuicFrameHeader.from_bytes(data, offset)
+                offset += FRAME_HEADER_SIZE
+
+                if frame_header.frame_type == QuicFrameType.Ack:
+                    frame = QuicAckFrame.from_bytes(data, offset)
+                    offset += ACK_FRAME_SIZE
+                    logger.debug("Received %s", frame)
+                    self.handle_ack(frame)
+
+                elif frame_header.frame_type == QuicFrameType.Stream:
+                    frame = QuicStreamFrame.from_bytes(data, offset)
+                    logger.debug("Received %s", frame)
+                    self.handle_stream(header.packet_number, frame)
+                    # the stream data takes up the rest of the packet
+                    break
 
-            if frame_header.frame_type == QuicFrameType.Ack:
-                frame = QuicAckFrame.from_bytes(
-                    data[QuicPacketHeader.size() + QuicFrameHeader.size() :]
-                )
-                logger.debug(f"Received {frame}")
-                self.handle_ack(frame)
+        selector.close()
 
-            elif frame_header.frame_type == QuicFrameType.Stream:
-                frame = QuicStreamFrame.from_bytes(
-                    data[QuicPacketHeader.size() + QuicFrameHeader.size() :]
-                )
-                logger.debug(f"Received {frame}")
-                self.handle_stream(header.packet_number, frame)
+        # wake up recv() and close(), nothing will be received any more
+        with self.recv_condition:
+            self.recv_condition.notify_all()
+        with self.sent_condition:
+            self.sent_condition.notify_all()
 
     def handle_ack(self, ack: QuicAckFrame) -> None:
         """Handle an ACK frame."""
 
-        logger.debug(f"ACK {ack.packet_number}")
+        logger.debug("ACK %d", ack.packet_number)
 
-        for i, packet in enumerate(self.sender_window):
-            if packet.packet_number == ack.packet_number:
-                break
-        else:
+        packet = self.sender_window.pop(ack.packet_number, None)
+        if packet is None:
             # packet number not found
             return
-        logger.debug(f"Found at {i}: {packet}")
+        logger.debug("Found %s", packet)
 
-        self.sender_window.pop(i)
+        self.sender_wakeup.set()
+        with self.sent_condition:
+            self.sent_condition.notify_all()
+
+        # the acks of an application-limited sender say nothing about how much
+        # more the network can take
+        if not packet.window_limited:
+            return
+
+        # every ack grows the window by a packet in slow start, doubling it
+        # each round trip, and by a packet per round trip afterwards
         if self.exponential_growth:
-            self.sender_window_size *= 2
-        else:
             self.sender_window_size += 1
+        else:
+            self.sender_window_size += 1 / self.sender_window_size
 
         if self.sender_window_size > self.max_window_size:
             self.sender_window_size = self.max_window_size
@@ -370,8 +545,13 @@ class QuicConnection:
     def handle_stream(self, packet_number: int, frame: QuicStreamFrame) -> None:
         """Handle a STREAM frame."""
 
-        self.recv_buffer.setdefault(frame.stream_id, []).append(frame)
+        with self.recv_condition:
+            stream = self.recv_buffer[frame.stream_id]
+            stream.add(frame)
+            if stream.has_message():
+                self.recv_condition.notify_all()
 
         # send an ACK frame
         ack = QuicAckFrame(packet_number=packet_number, window_size=RECEIVE_SIZE)
         self.ack_list.append(ack)
+        self.sender_wakeup.set()